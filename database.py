@@ -5,28 +5,136 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+import redis.asyncio as redis
 from datetime import datetime, timezone
 import os
+import logging
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 _client = None
 db = None
+cache = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# Connection pool is per worker process: keep DB_POOL_SIZE x WEB_CONCURRENCY
+# below the server's connection limit. Timeouts are short so an exhausted pool
+# or unreachable server fails fast instead of queueing requests.
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("DB_POOL_SIZE", 50)),
+        minPoolSize=int(os.getenv("DB_MIN_POOL", 5)),
+        serverSelectionTimeoutMS=3000,
+        waitQueueTimeoutMS=5000,
+        socketTimeoutMS=10000,
+        retryWrites=True,
+    )
     db = _client[database_name]
 
+# Optional Redis cache for hot read endpoints
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    cache = redis.from_url(redis_url)
+
+async def close_connections():
+    """Close the Mongo and Redis clients"""
+    if _client is not None:
+        _client.close()
+    if cache is not None:
+        await cache.aclose()
+
+async def ensure_indexes():
+    """Create the indexes the booking endpoints query on"""
+    if db is None:
+        return
+    # Prefix also serves hotel_id-only room lookups
+    await db["room"].create_index([("hotel_id", 1), ("capacity", 1)])
+    await db["booking"].create_index([("room_id", 1), ("check_in", 1), ("check_out", 1)])
+    await db["booking"].create_index("hotel_id")
+
+# One-off data migrations record a marker document in the "migration"
+# collection once they complete, so later boots skip them entirely
+
+async def _migration_done(name: str) -> bool:
+    return await db["migration"].count_documents({"_id": name}, limit=1) > 0
+
+async def _mark_migration_done(name: str):
+    await db["migration"].update_one(
+        {"_id": name}, {"$set": {"completed_at": datetime.now(timezone.utc)}}, upsert=True
+    )
+
+async def migrate_booking_dates():
+    """Convert legacy ISO-string booking dates to BSON Date (one-off, idempotent)"""
+    if db is None or await _migration_done("booking_dates"):
+        return
+    for field in ("check_in", "check_out"):
+        # Unparseable strings are left as they are rather than failing the batch
+        await db["booking"].update_many(
+            {field: {"$type": "string"}},
+            [{"$set": {field: {"$dateFromString": {"dateString": f"${field}", "onError": f"${field}"}}}}],
+        )
+    leftover = await db["booking"].count_documents(
+        {"$or": [{"check_in": {"$type": "string"}}, {"check_out": {"$type": "string"}}]}
+    )
+    if leftover:
+        logger.warning("%d bookings kept unparseable string dates", leftover)
+    await _mark_migration_done("booking_dates")
+
+def _stay_ordinal(value):
+    """Day ordinal of a stored stay date (BSON Date or legacy ISO string)"""
+    if isinstance(value, datetime):
+        return value.toordinal()
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).toordinal()
+        except ValueError:
+            return None
+    return None
+
+async def backfill_booked_intervals(batch_size: int = 1000):
+    """Push each booking's dates into its room's booked_intervals (one-off, idempotent)"""
+    if db is None or await _migration_done("booked_intervals"):
+        return
+    ops = []
+    cursor = db["booking"].find({}, {"room_id": 1, "check_in": 1, "check_out": 1}).batch_size(batch_size)
+    async for b in cursor:
+        try:
+            room_oid = ObjectId(b["room_id"])
+        except (InvalidId, TypeError, KeyError):
+            logger.warning("Skipping booking %s: invalid room_id", b["_id"])
+            continue
+        ci = _stay_ordinal(b.get("check_in"))
+        co = _stay_ordinal(b.get("check_out"))
+        if ci is None or co is None:
+            logger.warning("Skipping booking %s: missing or invalid dates", b["_id"])
+            continue
+        ops.append(UpdateOne(
+            {"_id": room_oid, "booked_intervals.bid": {"$ne": b["_id"]}},
+            {"$push": {"booked_intervals": {"ci": ci, "co": co, "bid": b["_id"]}}},
+        ))
+        if len(ops) >= batch_size:
+            await db["room"].bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db["room"].bulk_write(ops, ordered=False)
+    await _mark_migration_done("booked_intervals")
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,10 +148,26 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """Insert many documents with timestamps in a single round-trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = await db[collection_name].insert_many(docs, ordered=False)
+    return [str(_id) for _id in result.inserted_ids]
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +176,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
@@ -1,40 +1,270 @@
 import os
-from fastapi import FastAPI, HTTPException
+import re
+import asyncio
+import logging
+import orjson
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import AfterValidator, BaseModel
 from bson.objectid import ObjectId
-from datetime import datetime
-from typing import List, Optional
-
-from database import db, create_document, get_documents
-from schemas import Hotel, Room, Booking
-
-app = FastAPI()
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+from datetime import date, datetime
+from typing import Annotated, List, Optional, Union
+
+from database import (
+    db, cache, create_document, create_documents, ensure_indexes,
+    migrate_booking_dates, backfill_booked_intervals, close_connections,
+)
+from schemas import Booking
+
+
+logger = logging.getLogger(__name__)
+
+
+# Startup tasks: date migration, booked_intervals backfill and indexes. Each
+# step is guarded on its own; any that fail are retried in the background
+# until they succeed. Until the backfill succeeds, booking and availability
+# also consult the booking collection (see intervals_backfilled).
+
+STARTUP_RETRY_SECONDS = 30
+
+
+async def run_startup_tasks(app: FastAPI) -> bool:
+    state = app.state
+    if not state.dates_migrated:
+        try:
+            await migrate_booking_dates()
+            state.dates_migrated = True
+        except PyMongoError as e:
+            logger.warning("Booking date migration failed: %s", e)
+    if not state.intervals_backfilled:
+        try:
+            await backfill_booked_intervals()
+            state.intervals_backfilled = True
+        except PyMongoError as e:
+            logger.warning("booked_intervals backfill failed: %s", e)
+    if not state.indexes_ready:
+        try:
+            await ensure_indexes()
+            state.indexes_ready = True
+        except PyMongoError as e:
+            logger.warning("Index creation failed: %s", e)
+    return state.dates_migrated and state.intervals_backfilled and state.indexes_ready
+
+
+async def retry_startup_tasks(app: FastAPI):
+    while True:
+        await asyncio.sleep(STARTUP_RETRY_SECONDS)
+        if await run_startup_tasks(app):
+            logger.info("Deferred MongoDB startup tasks completed")
+            return
+
+
+# Open Mongo/Redis connections before accepting traffic so the first burst of
+# requests doesn't race to establish them, and release them on shutdown. An
+# unreachable backend is logged and the app starts degraded; /test reports it.
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.dates_migrated = False
+    app.state.intervals_backfilled = False
+    app.state.indexes_ready = False
+    retry_task = None
+    if db is not None:
+        try:
+            await db.command("ping")
+        except PyMongoError as e:
+            logger.warning("MongoDB ping failed: %s", e)
+        if not await run_startup_tasks(app):
+            retry_task = asyncio.create_task(retry_startup_tasks(app))
+    if cache is not None:
+        try:
+            await cache.ping()
+        except RedisError as e:
+            logger.warning("Redis ping failed: %s", e)
+    yield
+    if retry_task is not None:
+        retry_task.cancel()
+    await close_connections()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Wildcard origins cannot be combined with credentials; only enable
+# credentials when CORS_ORIGINS lists explicit origins
+cors_origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=cors_origins,
+    allow_credentials="*" not in cors_origins,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# Utility to convert Mongo _id to string
+# Hotel and booking lists are repetitive JSON; compress anything over 1 KB
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Utility to convert Mongo _id to string (mutates the driver's dict in place)
 
 def serialize_doc(doc):
-    doc = dict(doc)
-    if doc.get("_id"):
-        doc["id"] = str(doc.pop("_id"))
+    oid = doc.pop("_id", None)
+    if oid is not None:
+        doc["id"] = str(oid)
     return doc
 
 
+# Bookings store stay dates as midnight datetimes; the API keeps returning
+# them as YYYY-MM-DD strings as it did before they were stored as BSON Date
+
+def serialize_booking(doc):
+    for field in ("check_in", "check_out"):
+        value = doc.get(field)
+        if isinstance(value, datetime):
+            doc[field] = value.date().isoformat()
+    return serialize_doc(doc)
+
+
+# Ids arrive as strings from paths and bodies; validate the 24-hex shape up
+# front and reuse ObjectId instances for ids seen repeatedly
+
+_OBJECT_ID_RE = re.compile(r"[0-9a-fA-F]{24}")
+
+
+@lru_cache(maxsize=1024)
+def to_object_id(value: str) -> ObjectId:
+    if not _OBJECT_ID_RE.fullmatch(value):
+        raise HTTPException(status_code=400, detail="Invalid id")
+    return ObjectId(value)
+
+
+# BSON has no date type; stay dates are stored as midnight datetimes
+
+def to_bson_date(d: date) -> datetime:
+    return datetime.combine(d, datetime.min.time())
+
+
+# Overlap checks. Each room's booked_intervals array (day ordinals) is the
+# source of truth for both /availability and /book. Invariant: every booking
+# has a matching interval on its room. A leftover interval whose booking
+# insert failed only makes the room look booked on both endpoints, never
+# double-booked. Bookings that predate the array are backfilled at startup;
+# until that has run, the booking collection is checked as well.
+
+def intervals_backfilled() -> bool:
+    return getattr(app.state, "intervals_backfilled", False)
+
+
+def interval_free_filter(ci_ord: int, co_ord: int) -> dict:
+    return {"booked_intervals": {"$not": {"$elemMatch": {"ci": {"$lt": co_ord}, "co": {"$gt": ci_ord}}}}}
+
+
+def booking_overlap_filter(ci: date, co: date) -> dict:
+    # Legacy bookings keep ISO-string dates until the date migration has run.
+    # BSON never compares strings with dates, so match both representations;
+    # YYYY-MM-DD strings order correctly lexicographically.
+    return {"$or": [
+        {"check_in": {"$lt": to_bson_date(co)}, "check_out": {"$gt": to_bson_date(ci)}},
+        {"check_in": {"$lt": co.isoformat()}, "check_out": {"$gt": ci.isoformat()}},
+    ]}
+
+
+# Redis helpers: hotel payloads are cached as JSON bytes. A missing or
+# unreachable cache is treated as a miss so reads fall back to Mongo.
+
+HOTEL_CACHE_TTL = int(os.getenv("HOTEL_CACHE_TTL", 120))
+
+
+async def cache_get(key: str):
+    if cache is None:
+        return None
+    try:
+        return await cache.get(key)
+    except RedisError:
+        return None
+
+
+async def cache_set(key: str, payload: bytes, ttl: int = HOTEL_CACHE_TTL):
+    if cache is None:
+        return
+    try:
+        await cache.setex(key, ttl, payload)
+    except RedisError:
+        pass
+
+
+async def cache_delete(*keys: str):
+    if cache is None:
+        return
+    try:
+        await cache.delete(*keys)
+    except RedisError:
+        pass
+
+
+def json_response(payload: bytes) -> Response:
+    return Response(content=payload, media_type="application/json")
+
+
+# Stream a cursor as a JSON array without materializing the whole result.
+# Encoded documents are buffered and sent once per cursor batch (or every
+# STREAM_CHUNK_BYTES) so each ASGI/GZip write carries many documents. With a
+# cache_key the encoded body is also written to the cache once the cursor is
+# exhausted; bodies larger than STREAM_CACHE_MAX_BYTES are not cached, so
+# memory stays bounded. Once streaming has started, a cursor error can only
+# truncate the 200 response, not turn it into a 500.
+
+STREAM_BATCH_SIZE = 500
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_CACHE_MAX_BYTES = int(os.getenv("STREAM_CACHE_MAX_BYTES", 1024 * 1024))
+
+
+async def stream_json_array(cursor, cache_key: Optional[str] = None, serialize=serialize_doc):
+    parts = [] if cache_key else None
+    cached_size = 0
+    buf = [b"["]
+    size = 1
+    pending = 0
+    first = True
+    async for doc in cursor.batch_size(STREAM_BATCH_SIZE):
+        if not first:
+            buf.append(b",")
+        first = False
+        encoded = orjson.dumps(serialize(doc))
+        buf.append(encoded)
+        size += len(encoded) + 1
+        pending += 1
+        if pending >= STREAM_BATCH_SIZE or size >= STREAM_CHUNK_BYTES:
+            chunk = b"".join(buf)
+            if parts is not None:
+                cached_size += len(chunk)
+                if cached_size <= STREAM_CACHE_MAX_BYTES:
+                    parts.append(chunk)
+                else:
+                    # Too large to cache: stop buffering and just stream
+                    parts = None
+            yield chunk
+            buf, size, pending = [], 0, 0
+    buf.append(b"]")
+    tail = b"".join(buf)
+    if parts is not None:
+        parts.append(tail)
+        await cache_set(cache_key, b"".join(parts))
+    yield tail
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Hotel Booking API ready"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -51,7 +281,7 @@ def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                response["collections"] = db.list_collection_names()[:10]
+                response["collections"] = (await db.list_collection_names())[:10]
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
         else:
@@ -64,169 +294,234 @@ def test_database():
 
 # Seed data route to quickly add sample hotels/rooms
 @app.post("/seed")
-def seed_data():
+async def seed_data():
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
     hotels = [
-        Hotel(
-            name="Seaside Resort",
-            location="Malibu, USA",
-            description="Oceanfront stays with stunning sunsets.",
-            rating=4.7,
-            amenities=["Pool", "WiFi", "Breakfast", "Spa"],
-            image_url="https://images.unsplash.com/photo-1501117716987-c8e2a9ce5e1d?auto=format&fit=crop&w=1200&q=60",
-        ),
-        Hotel(
-            name="Mountain Lodge",
-            location="Zermatt, Switzerland",
-            description="Cozy lodge with alpine views.",
-            rating=4.6,
-            amenities=["WiFi", "Sauna", "Restaurant"],
-            image_url="https://images.unsplash.com/photo-1528909514045-2fa4ac7a08ba?auto=format&fit=crop&w=1200&q=60",
-        ),
+        {
+            "name": "Seaside Resort",
+            "location": "Malibu, USA",
+            "description": "Oceanfront stays with stunning sunsets.",
+            "rating": 4.7,
+            "amenities": ["Pool", "WiFi", "Breakfast", "Spa"],
+            "image_url": "https://images.unsplash.com/photo-1501117716987-c8e2a9ce5e1d?auto=format&fit=crop&w=1200&q=60",
+        },
+        {
+            "name": "Mountain Lodge",
+            "location": "Zermatt, Switzerland",
+            "description": "Cozy lodge with alpine views.",
+            "rating": 4.6,
+            "amenities": ["WiFi", "Sauna", "Restaurant"],
+            "image_url": "https://images.unsplash.com/photo-1528909514045-2fa4ac7a08ba?auto=format&fit=crop&w=1200&q=60",
+        },
     ]
 
-    hotel_ids = []
-    for h in hotels:
-        hid = create_document("hotel", h)
-        hotel_ids.append(hid)
+    hotel_ids = await create_documents("hotel", hotels)
 
     rooms = [
-        Room(
-            hotel_id=hotel_ids[0],
-            name="Deluxe Ocean View",
-            price_per_night=320,
-            capacity=2,
-            amenities=["Balcony", "King Bed", "Mini Bar"],
-            images=["https://images.unsplash.com/photo-1505691723518-36a5ac3b2d95?auto=format&fit=crop&w=1200&q=60"],
-        ),
-        Room(
-            hotel_id=hotel_ids[0],
-            name="Family Suite",
-            price_per_night=450,
-            capacity=4,
-            amenities=["Two Bedrooms", "Kitchenette"],
-            images=["https://images.unsplash.com/photo-1505691938895-1758d7feb511?auto=format&fit=crop&w=1200&q=60"],
-        ),
-        Room(
-            hotel_id=hotel_ids[1],
-            name="Alpine Classic",
-            price_per_night=280,
-            capacity=2,
-            amenities=["Queen Bed", "Mountain View"],
-        ),
+        {
+            "hotel_id": hotel_ids[0],
+            "name": "Deluxe Ocean View",
+            "price_per_night": 320.0,
+            "capacity": 2,
+            "amenities": ["Balcony", "King Bed", "Mini Bar"],
+            "images": ["https://images.unsplash.com/photo-1505691723518-36a5ac3b2d95?auto=format&fit=crop&w=1200&q=60"],
+        },
+        {
+            "hotel_id": hotel_ids[0],
+            "name": "Family Suite",
+            "price_per_night": 450.0,
+            "capacity": 4,
+            "amenities": ["Two Bedrooms", "Kitchenette"],
+            "images": ["https://images.unsplash.com/photo-1505691938895-1758d7feb511?auto=format&fit=crop&w=1200&q=60"],
+        },
+        {
+            "hotel_id": hotel_ids[1],
+            "name": "Alpine Classic",
+            "price_per_night": 280.0,
+            "capacity": 2,
+            "amenities": ["Queen Bed", "Mountain View"],
+            "images": None,
+        },
     ]
 
-    for r in rooms:
-        create_document("room", r)
+    await create_documents("room", rooms)
 
+    await cache_delete("hotel:list")
     return {"inserted_hotels": len(hotels), "inserted_rooms": len(rooms)}
 
 
 # Public endpoints
 @app.get("/hotels")
-def list_hotels():
-    items = get_documents("hotel")
-    return [serialize_doc(i) for i in items]
+async def list_hotels():
+    cached = await cache_get("hotel:list")
+    if cached is not None:
+        return json_response(cached)
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    return StreamingResponse(
+        stream_json_array(db["hotel"].find(), cache_key="hotel:list"),
+        media_type="application/json",
+    )
+
+
+HOTEL_FIELDS = {"name": 1, "location": 1, "description": 1, "rating": 1, "amenities": 1, "image_url": 1}
 
 
 @app.get("/hotels/{hotel_id}")
-def get_hotel(hotel_id: str):
+async def get_hotel(hotel_id: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    doc = db["hotel"].find_one({"_id": ObjectId(hotel_id)})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Hotel not found")
-    rooms = list(db["room"].find({"hotel_id": hotel_id}))
-    return {"hotel": serialize_doc(doc), "rooms": [serialize_doc(r) for r in rooms]}
+    oid = to_object_id(hotel_id)
+    key = f"hotel:{hotel_id}"
+    cached = await cache_get(key)
+    if cached is None:
+        doc = await db["hotel"].find_one({"_id": oid}, HOTEL_FIELDS)
+        if not doc:
+            raise HTTPException(status_code=404, detail="Hotel not found")
+        rooms = await db["room"].find({"hotel_id": hotel_id}, {"booked_intervals": 0}).to_list(length=None)
+        cached = orjson.dumps({"hotel": serialize_doc(doc), "rooms": [serialize_doc(r) for r in rooms]})
+        await cache_set(key, cached)
+    return json_response(cached)
+
+
+# Accept plain dates as well as full ISO datetimes (e.g. "2025-01-02T10:00"),
+# keeping only the date part, as the endpoint always has
+
+def _date_part(value: Union[date, datetime]) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+StayDate = Annotated[Union[date, datetime], AfterValidator(_date_part)]
 
 
 class AvailabilityQuery(BaseModel):
-    check_in: str
-    check_out: str
+    check_in: StayDate
+    check_out: StayDate
     guests: int = 1
 
 
 @app.post("/availability/{hotel_id}")
-def check_availability(hotel_id: str, payload: AvailabilityQuery):
+async def check_availability(hotel_id: str, payload: AvailabilityQuery):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
     # For demo: a room is unavailable if there's any overlap with existing bookings
-    try:
-        from datetime import date
-        from datetime import datetime as dt
-        ci = dt.fromisoformat(payload.check_in).date()
-        co = dt.fromisoformat(payload.check_out).date()
-        if co <= ci:
-            raise HTTPException(status_code=400, detail="Check-out must be after check-in")
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format, use YYYY-MM-DD")
-
-    rooms = list(db["room"].find({"hotel_id": hotel_id}))
-
-    available_rooms = []
-    for room in rooms:
-        bookings = list(db["booking"].find({"room_id": str(room["_id"])}))
-        overlap = False
-        for b in bookings:
-            b_ci = datetime.fromisoformat(b["check_in"]).date()
-            b_co = datetime.fromisoformat(b["check_out"]).date()
-            if not (co <= b_ci or ci >= b_co):
-                overlap = True
-                break
-        if not overlap and payload.guests <= room.get("capacity", 1):
-            available_rooms.append(serialize_doc(room))
+    ci = payload.check_in
+    co = payload.check_out
+    if co <= ci:
+        raise HTTPException(status_code=400, detail="Check-out must be after check-in")
+
+    # Rooms with enough capacity and no booked interval overlapping [ci, co)
+    pipeline = [
+        {"$match": {
+            "hotel_id": hotel_id,
+            "capacity": {"$gte": payload.guests},
+            **interval_free_filter(ci.toordinal(), co.toordinal()),
+        }},
+    ]
+    if not intervals_backfilled():
+        # Also join legacy bookings. The join on room_id plus a plain range
+        # $match lets the booking (room_id, check_in, check_out) index answer
+        # each room's probe as a bounded index scan (requires MongoDB 5.0+).
+        pipeline += [
+            {"$addFields": {"room_key": {"$toString": "$_id"}}},
+            {"$lookup": {
+                "from": "booking",
+                "localField": "room_key",
+                "foreignField": "room_id",
+                "pipeline": [
+                    {"$match": booking_overlap_filter(ci, co)},
+                    {"$project": {"_id": 1}},
+                    {"$limit": 1},
+                ],
+                "as": "conflicts",
+            }},
+            {"$match": {"conflicts": {"$size": 0}}},
+        ]
+    pipeline.append({"$project": {"conflicts": 0, "room_key": 0, "booked_intervals": 0}})
+    rooms = await db["room"].aggregate(pipeline).to_list(length=None)
+    available_rooms = [serialize_doc(r) for r in rooms]
 
     return {"available": available_rooms}
 
 
 @app.post("/book")
-def create_booking(payload: Booking):
+async def create_booking(payload: Booking):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    # Ensure room exists
-    room = db["room"].find_one({"_id": ObjectId(payload.room_id)})
-    if not room:
-        raise HTTPException(status_code=404, detail="Room not found")
-
-    # Check for overlaps
-    bookings = list(db["booking"].find({"room_id": payload.room_id}))
     ci = payload.check_in
     co = payload.check_out
-    if isinstance(ci, str):
-        from datetime import datetime as dt
-        ci = dt.fromisoformat(ci).date()
-        co = dt.fromisoformat(co).date()
-
-    for b in bookings:
-        b_ci = datetime.fromisoformat(b["check_in"]).date()
-        b_co = datetime.fromisoformat(b["check_out"]).date()
-        if not (co <= b_ci or ci >= b_co):
-            raise HTTPException(status_code=400, detail="Selected dates overlap with an existing booking")
+    if co <= ci:
+        raise HTTPException(status_code=400, detail="Check-out must be after check-in")
+    ci_dt = to_bson_date(ci)
+    co_dt = to_bson_date(co)
+    ci_ord = ci.toordinal()
+    co_ord = co.toordinal()
+
+    room_oid = to_object_id(payload.room_id)
+
+    # Legacy bookings never change, so checking them before the claim is safe
+    if not intervals_backfilled():
+        legacy = await db["booking"].find_one(
+            {"room_id": payload.room_id, **booking_overlap_filter(ci, co)},
+            {"_id": 1},
+        )
+        if legacy:
+            raise HTTPException(status_code=409, detail="Selected dates overlap with an existing booking")
+
+    # Claim the dates on the room atomically: the push only applies if none of
+    # the room's booked intervals overlap [ci, co), so concurrent requests for
+    # the same dates cannot both succeed. Intervals are stored as day ordinals
+    # so the guard compares small ints.
+    booking_oid = ObjectId()
+    room = await db["room"].find_one_and_update(
+        {"_id": room_oid, **interval_free_filter(ci_ord, co_ord)},
+        {"$push": {"booked_intervals": {"ci": ci_ord, "co": co_ord, "bid": booking_oid}}},
+        projection={"price_per_night": 1},
+    )
+    if not room:
+        if not await db["room"].count_documents({"_id": room_oid}, limit=1):
+            raise HTTPException(status_code=404, detail="Room not found")
+        raise HTTPException(status_code=409, detail="Selected dates overlap with an existing booking")
 
     # Compute total
-    nights = (co - ci).days
+    nights = co_ord - ci_ord
     total = nights * room.get("price_per_night", 0)
 
     booking_doc = payload.model_dump()
-    booking_doc["check_in"] = ci.isoformat()
-    booking_doc["check_out"] = co.isoformat()
+    booking_doc["check_in"] = ci_dt
+    booking_doc["check_out"] = co_dt
     booking_doc["total_price"] = total
+    booking_doc["_id"] = booking_oid
 
-    bid = create_document("booking", booking_doc)
+    try:
+        bid = await create_document("booking", booking_doc)
+    except Exception:
+        # Release the claimed dates only if the booking definitely wasn't
+        # stored: after a timeout the insert may still have been applied, and
+        # the id is client-generated so this lookup is exact
+        if not await db["booking"].find_one({"_id": booking_oid}, {"_id": 1}):
+            await db["room"].update_one({"_id": room_oid}, {"$pull": {"booked_intervals": {"bid": booking_oid}}})
+        raise
     return {"booking_id": bid, "total_price": total, "status": "confirmed"}
 
 
 @app.get("/bookings")
-def list_bookings():
-    items = get_documents("booking")
-    return [serialize_doc(i) for i in items]
+async def list_bookings():
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    return StreamingResponse(
+        stream_json_array(db["booking"].find(), serialize=serialize_booking),
+        media_type="application/json",
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    # Import string (not the app object) is required for workers > 1
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")